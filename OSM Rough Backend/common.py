@@ -0,0 +1,39 @@
+import os
+import math
+
+"""
+Helpers shared by the web app (app.py) and the worker pipeline (pipeline.py).
+
+Kept free of heavy imports so the web process does not load the SUMO / numpy /
+aiohttp stack just to validate a bbox or locate a trace.
+"""
+
+# Per-task outputs live under DATA_DIR/<task_id>/; pipeline.py creates it
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+OSM_CACHE_GRID = 0.001  # degrees (~100 m); nearby selections share one download
+
+# How long a simulation task may wait in the queue, and then how long it may run
+SIMULATION_TIMEOUT = int(os.environ.get('SIMULATION_TIMEOUT', 600))  # seconds
+
+
+def normalize_bbox(bbox):
+    """Order [lon1, lat1, lon2, lat2] as [west, south, east, north] and snap it to the cache grid."""
+    lon1, lat1, lon2, lat2 = map(float, bbox)
+    west = min(lon1, lon2)
+    east = max(lon1, lon2)
+    south = min(lat1, lat2)
+    north = max(lat1, lat2)
+    return snap_bbox(west, south, east, north)
+
+
+def snap_bbox(west, south, east, north, grid=OSM_CACHE_GRID):
+    """Grow the bbox outward to the cache grid so near-identical selections hit the same key."""
+    # Round before floor/ceil so an already-snapped bbox maps onto itself
+    def down(v):
+        return round(math.floor(round(v / grid, 6)) * grid, 6)
+
+    def up(v):
+        return round(math.ceil(round(v / grid, 6)) * grid, 6)
+
+    return [down(west), down(south), up(east), up(north)]
@@ -0,0 +1,479 @@
+import os
+import sys
+import asyncio
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import functools
+import subprocess
+import aiohttp
+from lxml import etree
+try:
+    from pyproj import CRS, Transformer
+except Exception:
+    CRS = Transformer = None
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+import trace_to_json
+from common import DATA_DIR, SIMULATION_TIMEOUT, normalize_bbox
+
+"""
+OSM -> SUMO -> trace.json pipeline, run by the Celery worker (see worker/worker.py).
+
+Each run writes into its own work directory (DATA_DIR/<task_id>/) so concurrent
+simulations never share map.osm / *.net.xml / trace files.
+"""
+
+# Ensure data directory exists
+if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
+
+# On-disk cache of Overpass downloads, keyed by the bbox snapped to a coarse grid (see common.snap_bbox)
+OSM_CACHE_DIR = os.path.join(DATA_DIR, 'osm_cache')
+OSM_CACHE_TTL = int(os.environ.get('OSM_CACHE_TTL', 24 * 3600))  # seconds
+OSM_CACHE_MAX_MB = int(os.environ.get('OSM_CACHE_MAX_MB', 500))
+os.makedirs(OSM_CACHE_DIR, exist_ok=True)
+
+# A finished task keeps only the trace copies served by /simulate/<task_id>/trace
+TRACE_FILES = ('trace.json', 'trace.json.gz', 'trace.json.zst')
+TASK_DIR_TTL = int(os.environ.get('TASK_DIR_TTL', 24 * 3600))  # seconds; Celery's default result_expires
+
+SUMO_HOME = os.environ.get('SUMO_HOME')
+
+# Auto-detect SUMO_HOME if installed via pip
+if not SUMO_HOME:
+    import site
+    for site_pkg in site.getsitepackages():
+        possible_home = os.path.join(site_pkg, 'sumo')
+        if os.path.exists(os.path.join(possible_home, 'bin', 'sumo')):
+            SUMO_HOME = possible_home
+            print(f"Auto-detected SUMO_HOME: {SUMO_HOME}")
+            break
+
+if SUMO_HOME:
+    NETCONVERT = os.path.join(SUMO_HOME, 'bin', 'netconvert')
+    SUMO_BIN = os.path.join(SUMO_HOME, 'bin', 'sumo')
+    SUMO_TOOLS = os.path.join(SUMO_HOME, 'tools')
+else:
+    NETCONVERT = SUMO_BIN = SUMO_TOOLS = None
+
+# libsumo runs the simulation inside this process; it ships in SUMO's tools dir or as the `libsumo` wheel
+if SUMO_TOOLS and SUMO_TOOLS not in sys.path:
+    sys.path.append(SUMO_TOOLS)
+try:
+    import libsumo
+except ImportError:
+    libsumo = None
+
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+
+
+def overpass_query(bbox):
+    """Overpass QL for the routable part of `bbox`: highway ways plus the nodes they use.
+
+    `out body` keeps the tags netconvert reads (highway, lanes, oneway, signals) but
+    skips the user/version/timestamp metadata that /api/map returns.
+    """
+    west, south, east, north = bbox
+    return ('[out:xml][timeout:60];'
+            f'(way["highway"]({south:.4f},{west:.4f},{north:.4f},{east:.4f});>;);'
+            'out body;')
+
+
+# In-progress downloads; ends in .osm because pyosmium picks the reader from the suffix
+DOWNLOAD_SUFFIX = '.tmp.osm'
+
+
+def osm_cache_path(bbox):
+    # Key on the query itself so a change to the filter never serves stale extracts
+    key = hashlib.sha1(overpass_query(bbox).encode()).hexdigest()
+    return os.path.join(OSM_CACHE_DIR, key + '.osm')
+
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst so no bytes are rewritten; copy where links are unsupported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def evict_osm_cache():
+    """Remove least recently used cache files until the cache fits in OSM_CACHE_MAX_MB."""
+    entries = []
+    for name in os.listdir(OSM_CACHE_DIR):
+        path = os.path.join(OSM_CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith(DOWNLOAD_SUFFIX):
+            # Another run's download in progress: removing it would break its os.replace.
+            # Older ones were left by a killed worker (a task never runs longer than SIMULATION_TIMEOUT).
+            if time.time() - st.st_mtime > SIMULATION_TIMEOUT:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            continue
+        entries.append((st, path))
+    total = sum(st.st_size for st, _ in entries)
+    # Hits bump atime (mtime is kept for the TTL), so oldest atime == least recently used
+    for st, path in sorted(entries, key=lambda e: e[0].st_atime):
+        if total <= OSM_CACHE_MAX_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= st.st_size
+
+
+def prune_work_dir(work_dir, keep=TRACE_FILES):
+    """Delete a run's intermediate files (map.osm, nets, trips); drop the directory if nothing is kept."""
+    if not os.path.isdir(work_dir):
+        return
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return
+    for entry in os.scandir(work_dir):
+        if entry.name in keep:
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def evict_task_dirs():
+    """Remove task directories older than TASK_DIR_TTL; by then their Celery results have expired too."""
+    cutoff = time.time() - TASK_DIR_TTL
+    for entry in os.scandir(DATA_DIR):
+        if entry.path == OSM_CACHE_DIR or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+if osmium is not None:
+    class HighwayCounter(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.ways = 0
+
+        def way(self, w):
+            if 'highway' in w.tags:
+                self.ways += 1
+
+
+def count_highways(osm_file):
+    """Number of highway ways in an OSM extract (pyosmium's C++ reader if installed, else lxml)."""
+    if osmium is not None:
+        handler = HighwayCounter()
+        handler.apply_file(osm_file)
+        return handler.ways
+
+    count = 0
+    for _, elem in etree.iterparse(osm_file, events=('end',), tag=('node', 'way', 'relation')):
+        if elem.tag == 'way' and elem.find("tag[@k='highway']") is not None:
+            count += 1
+        # Drop every processed element (and earlier siblings) so memory stays flat
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return count
+
+
+@functools.lru_cache(maxsize=32)
+def get_transformer(proj_param):
+    """lon/lat -> net projection. Cached: PROJ setup is costly and nets in one area share a projection."""
+    return Transformer.from_crs('EPSG:4326', CRS.from_proj4(proj_param), always_xy=True)
+
+
+async def run_tool(*cmd):
+    """Run an external SUMO tool without blocking the event loop; raises like subprocess.run(check=True)."""
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    returncode = await proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def random_trips(net_file, trips_file):
+    """Run SUMO's randomTrips.py in-process, skipping interpreter start-up and the sumolib re-import."""
+    if SUMO_TOOLS not in sys.path:
+        sys.path.insert(0, SUMO_TOOLS)
+    import randomTrips
+
+    # Its argparse / sys.exit error paths would otherwise raise SystemExit, which Celery
+    # re-raises and which kills the pool child instead of failing the task
+    try:
+        options = randomTrips.get_options(['-n', net_file, '-e', '100', '-o', trips_file])
+        ok = randomTrips.main(options) is not False
+    except SystemExit as e:
+        raise RuntimeError(f'randomTrips failed (exit status {e.code})') from e
+    if not ok:
+        raise RuntimeError('randomTrips failed to generate trips')
+
+
+class ConversionError(RuntimeError):
+    """The simulation ran but its trace could not be written as JSON."""
+
+
+def simulate_with_libsumo(net_file, trips_file, trace_json_path, end=100):
+    """Run the simulation in-process and collect positions straight into a TraceBuffer (no FCD XML).
+
+    Raises ConversionError if the trace cannot be written; other exceptions are simulation failures.
+    """
+    buf = trace_to_json.TraceBuffer()
+    position = libsumo.constants.VAR_POSITION
+    libsumo.start(['sumo', '-n', net_file, '-r', trips_file, '--begin', '0', '--end', str(end), '--no-step-log'])
+    try:
+        while libsumo.simulation.getTime() < end:
+            # FCD labels each sample with the time of the step that produced it
+            time_ = libsumo.simulation.getTime()
+            libsumo.simulationStep()
+            # Subscribe each vehicle once as it departs, then fetch every position in one call per step;
+            # arrived vehicles drop out of the results by themselves
+            for vid in libsumo.simulation.getDepartedIDList():
+                libsumo.vehicle.subscribe(vid, [position])
+            for vid, values in libsumo.vehicle.getAllSubscriptionResults().items():
+                x, y = values[position]
+                buf.add(vid, time_, y, x)
+    finally:
+        libsumo.close()
+
+    try:
+        buf.write(trace_json_path)
+    except Exception as e:
+        raise ConversionError(str(e)) from e
+
+
+def simulate_to_json(net_file, trips_file, trace_json_path, work_dir):
+    """Run sumo and stream its FCD output straight into trace_to_json, without trace.xml on disk.
+
+    Raises CalledProcessError if sumo fails and ConversionError if its output cannot be converted.
+    """
+    cmd = [SUMO_BIN, '-n', net_file, '-r', trips_file, '--begin', '0', '--end', '100']
+
+    if not hasattr(os, 'mkfifo'):
+        # No named pipes (Windows): fall back to a temp file
+        trace = os.path.join(work_dir, 'trace.xml')
+        subprocess.run(cmd + ['--fcd-output', trace], check=True)
+        try:
+            trace_to_json.convert(trace, trace_json_path)
+        except Exception as e:
+            raise ConversionError(str(e)) from e
+        return
+
+    fifo = os.path.join(work_dir, 'trace.fifo')
+    os.mkfifo(fifo)
+    try:
+        proc = subprocess.Popen(cmd + ['--fcd-output', fifo])
+
+        # Opening the read end blocks until sumo opens the write end. If sumo exits
+        # before it gets there, open (and close) a writer ourselves so the reader sees EOF.
+        reader_done = threading.Event()
+
+        def unblock_reader():
+            proc.wait()
+            while not reader_done.is_set():
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                    return
+                except OSError:
+                    # ENXIO: the reader has not reached open() yet
+                    reader_done.wait(0.05)
+        threading.Thread(target=unblock_reader, daemon=True).start()
+
+        error = None
+        try:
+            with open(fifo, 'rb') as stream:
+                trace_to_json.convert(stream, trace_json_path)
+        except Exception as e:
+            error = e
+        finally:
+            reader_done.set()
+        returncode = proc.wait()
+    finally:
+        os.remove(fifo)
+
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd) from error
+    if error is not None:
+        raise ConversionError(str(error)) from error
+
+
+async def download_osm(bbox, osm_file):
+    try:
+        # Client timeout leaves headroom over the query's own [timeout:60]
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=90)) as session:
+            async with session.post(OVERPASS_URL, data={'data': overpass_query(bbox)}) as r:
+                r.raise_for_status()
+                content = await r.read()
+    except Exception as e:
+        raise RuntimeError(f'Failed to download OSM data: {e}') from e
+
+    with open(osm_file, 'wb') as f:
+        f.write(content)
+
+
+async def run_simulation(bbox, new_road, infra_type, work_dir):
+    """Build the net for `bbox` (plus optional `new_road`), simulate it and write work_dir/trace.json.
+
+    Returns a {'status', 'message'} dict; raises on download / SUMO failures.
+    """
+    if not SUMO_HOME:
+        raise RuntimeError('SUMO_HOME not set. Please install SUMO and set SUMO_HOME environment variable.')
+
+    os.makedirs(work_dir, exist_ok=True)
+    bbox = normalize_bbox(bbox)
+
+    # 1. Download OSM Data
+    osm_file = os.path.join(work_dir, 'map.osm')
+    cached_osm = osm_cache_path(bbox)
+    if os.path.exists(cached_osm) and time.time() - os.path.getmtime(cached_osm) < OSM_CACHE_TTL:
+        # Mark as recently used without extending its TTL
+        os.utime(cached_osm, (time.time(), os.path.getmtime(cached_osm)))
+        link_or_copy(cached_osm, osm_file)
+    else:
+        # Write under a temp name first so concurrent runs never read a partial file
+        fd, tmp = tempfile.mkstemp(suffix=DOWNLOAD_SUFFIX, dir=OSM_CACHE_DIR)
+        os.close(fd)
+        try:
+            await download_osm(bbox, tmp)
+            # Checked once per download, before caching, so an empty extract is never stored
+            # and cache hits skip the extra parse
+            if await asyncio.to_thread(count_highways, tmp) == 0:
+                raise RuntimeError('No roads found in the selected area.')
+            os.replace(tmp, cached_osm)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        # The response is written once, into the cache; the work dir just links to it
+        link_or_copy(cached_osm, osm_file)
+        evict_osm_cache()
+
+    # 2. Initial Conversion to SUMO Net
+    final_net = os.path.join(work_dir, 'final.net.xml')
+
+    if not new_road:
+        await run_tool(NETCONVERT, '--osm-files', osm_file, '-o', final_net, '--geometry.remove', '--ramps.guess')
+    else:
+        # Emit plain XML (nodes/edges/connections) instead of a full net, so the new road
+        # can be appended to small files and the net is built by a single netconvert pass
+        plain = os.path.join(work_dir, 'plain')
+        await run_tool(NETCONVERT, '--osm-files', osm_file, '--plain-output-prefix', plain, '--geometry.remove', '--ramps.guess')
+        nod = plain + '.nod.xml'
+        edg = plain + '.edg.xml'
+
+        # 3. Add New Infrastructure (Highway)
+        # Prefer to write node coordinates in the same projection as the base net.
+        # Extract projParameter from the plain nodes (netconvert output) and use pyproj to convert lon/lat -> projected x,y.
+        try:
+            # <location> sits at the top of the file, so stop as soon as it is seen
+            proj_param = None
+            offset_x = offset_y = 0.0
+            for _, loc in etree.iterparse(nod, events=('end',), tag='location'):
+                proj_param = loc.get('projParameter')
+                offset_x, offset_y = map(float, loc.get('netOffset', '0,0').split(','))
+                break
+
+            if proj_param and Transformer is not None:
+                transformer = get_transformer(proj_param)
+                # input is [lat, lon]; transform both endpoints in one call
+                lon1, lat1 = new_road['from'][1], new_road['from'][0]
+                lon2, lat2 = new_road['to'][1], new_road['to'][0]
+                (x1, x2), (y1, y2) = transformer.transform([lon1, lon2], [lat1, lat2])
+                # Plain node coordinates are relative to the net offset
+                x1, x2 = x1 + offset_x, x2 + offset_x
+                y1, y2 = y1 + offset_y, y2 + offset_y
+            else:
+                # Fallback: write raw lon/lat (may not align with net projection)
+                x1, y1 = new_road['from'][1], new_road['from'][0]
+                x2, y2 = new_road['to'][1], new_road['to'][0]
+        except Exception:
+            # On any parsing/transform error fall back to raw lon/lat
+            x1, y1 = new_road['from'][1], new_road['from'][0]
+            x2, y2 = new_road['to'][1], new_road['to'][0]
+
+        # Determine edge attributes based on infrastructure type
+        infra_type = infra_type or 'road'
+
+        # Default attributes
+        attributes = {'numLanes': '3', 'speed': '33.33', 'type': 'highway.motorway'}
+
+        # Apply OSM-style tags for structures
+        if infra_type == 'flyover':
+            # Layer 1 means above ground (bridge)
+            attributes.update(priority='20', shape='', spreadType='center')
+            # Note: SUMO uses specific attributes. For visualization/netconvert we can try to hint layer.
+            # However, raw edges in .edg.xml support standard attributes.
+            # To simulate a bridge, we can just ensure it connects correctly.
+            # But to be explicit for advanced users:
+            # We can add params if needed, but for now we stick to standard edge attributes.
+            # Let's add a "name" to identify it.
+            attributes['name'] = 'Proposed Flyover'
+
+        elif infra_type == 'tunnel':
+            attributes['name'] = 'Proposed Tunnel'
+
+        # Append with lxml so attribute values are always escaped correctly
+        nodes = etree.parse(nod)
+        # Z-height: SUMO supports 3D.
+        # Flyover: Start 0, Middle high? No, simple connection for now.
+        etree.SubElement(nodes.getroot(), 'node', id='start', x=str(x1), y=str(y1))
+        etree.SubElement(nodes.getroot(), 'node', id='end', x=str(x2), y=str(y2))
+        nodes.write(nod, xml_declaration=True, encoding='UTF-8')
+
+        edges = etree.parse(edg)
+        # To actually make it a bridge/tunnel in SUMO efficiently without conflicting
+        # with ground, we typically need 3D or ignoring conflicts.
+        # For this simplified demo, we just label it.
+        etree.SubElement(edges.getroot(), 'edge', {'id': 'new_hwy', 'from': 'start', 'to': 'end', **attributes})
+        edges.write(edg, xml_declaration=True, encoding='UTF-8')
+
+        inputs = ['-n', nod, '-e', edg, '-x', plain + '.con.xml']
+        if os.path.exists(plain + '.typ.xml'):
+            inputs += ['-t', plain + '.typ.xml']
+        if os.path.exists(plain + '.tll.xml'):
+            inputs += ['-i', plain + '.tll.xml']
+
+        # We add --ignore-errors to avoid connectivity complaints if endpoints are far from existing roads (though they should be close)
+        await run_tool(NETCONVERT, *inputs, '-o', final_net, '--ignore-errors')
+
+    # 4. Generate Random Traffic
+    trips = os.path.join(work_dir, 'trips.xml')
+    # randomTrips is plain Python; run it on a thread so the event loop stays free
+    await asyncio.to_thread(random_trips, final_net, trips)
+
+    # 5. Run SUMO and convert its Trace (FCD Output) to JSON as it is produced
+    trace_json_path = os.path.join(work_dir, 'trace.json')
+    try:
+        if libsumo is not None:
+            # No sumo process or FCD XML at all: positions are read through the libsumo API
+            await asyncio.to_thread(simulate_with_libsumo, final_net, trips, trace_json_path)
+        else:
+            await asyncio.to_thread(simulate_to_json, final_net, trips, trace_json_path, work_dir)
+    except ConversionError as e:
+        # Same result whichever way SUMO ran; simulation failures themselves still raise
+        return {'status': 'warning', 'message': 'Simulation ran but JSON conversion failed: ' + str(e)}
+
+    # Compress once here; the web app serves the stored bytes with Content-Encoding
+    await asyncio.to_thread(trace_to_json.write_compressed, trace_json_path)
+
+    return {'status': 'success', 'message': 'Simulation generated.'}
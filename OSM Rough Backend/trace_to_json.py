@@ -1,55 +1,135 @@
-import json
+import gzip
+import shutil
 import argparse
-import xml.etree.ElementTree as ET
+from array import array
+
+import numpy as np
+import orjson
+from lxml import etree
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 """
 Simple converter: sumo FCD trace.xml -> trace.json
 - Input: data/trace.xml (SUMO FCD output)
-- Output: data/trace.json
+- Output: data/trace.json (optionally also data/trace.npz, data/trace.json.gz / .zst)
 
 Output format:
 {
   "vehicles": {
-    "veh0": [{"time": 0.0, "lat": 52.5, "lon": 13.4}, ...],
+    "veh0": [[0.0, 52.5, 13.4], ...],
     ...
   }
 }
 
+Each sample is a [time, lat, lon] triple (kept positional to keep the output small).
+
+The optional .npz holds the same samples as flat columns: `time`, `lat`, `lon`
+grouped by vehicle, plus `ids` and `offsets` so vehicle i owns rows
+offsets[i]:offsets[i + 1].
+
 Notes:
 - SUMO FCD uses x=lon, y=lat for OSM-based nets created with netconvert.
 - If your net uses a projection, coordinates may need conversion.
 """
 
 
-def convert(input_path, output_path):
-    tree = ET.parse(input_path)
-    root = tree.getroot()
+class TraceBuffer:
+    """Collects FCD samples into flat typed columns instead of per-sample objects."""
+
+    def __init__(self):
+        self.ids = {}  # vehicle id -> index, in order of first appearance
+        self.vidx = array('q')
+        self.time = array('d')
+        self.lat = array('d')
+        self.lon = array('d')
+
+    def add(self, vid, time, lat, lon):
+        self.vidx.append(self.ids.setdefault(vid, len(self.ids)))
+        self.time.append(time)
+        self.lat.append(lat)
+        self.lon.append(lon)
+
+    def columns(self):
+        """Return (offsets, time, lat, lon) with rows grouped by vehicle, time-ordered within each."""
+        vidx = np.frombuffer(self.vidx, dtype=np.int64)
+        # Stable sort keeps each vehicle's samples in timestep order
+        order = np.argsort(vidx, kind='stable')
+        offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(vidx, minlength=len(self.ids)), out=offsets[1:])
+        time = np.frombuffer(self.time, dtype=np.float64)[order]
+        lat = np.frombuffer(self.lat, dtype=np.float64)[order]
+        lon = np.frombuffer(self.lon, dtype=np.float64)[order]
+        return offsets, time, lat, lon
+
+    def write(self, output_path, npz_path=None):
+        offsets, time, lat, lon = self.columns()
 
-    vehicles = {}
+        # Emit one vehicle at a time so the encoder never holds the whole document;
+        # the large buffer batches those small pieces into few write() calls
+        with open(output_path, 'wb', buffering=1 << 20) as f:
+            f.write(b'{"vehicles":{')
+            for i, vid in enumerate(self.ids):
+                start, end = offsets[i], offsets[i + 1]
+                samples = np.column_stack((time[start:end], lat[start:end], lon[start:end]))
+                if i:
+                    f.write(b',')
+                f.write(orjson.dumps(vid))
+                f.write(b':')
+                f.write(orjson.dumps(samples, option=orjson.OPT_SERIALIZE_NUMPY))
+            f.write(b'}}')
+
+        if npz_path:
+            np.savez(npz_path, ids=np.array(list(self.ids), dtype=str), offsets=offsets,
+                     time=time, lat=lat, lon=lon)
+
+
+def write_compressed(path):
+    """Write path.gz (and path.zst when zstandard is installed) next to a finished JSON file."""
+    # Stream in chunks so memory stays bounded like the JSON write itself
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    if zstandard is not None:
+        with open(path, 'rb') as src, open(path + '.zst', 'wb') as f:
+            with zstandard.ZstdCompressor(level=6).stream_writer(f) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def convert(input_path, output_path, npz_path=None):
+    buf = TraceBuffer()
 
     # SUMO FCD: <timestep time="0.00"> <vehicle id="veh0" x="..." y="..." /> </timestep>
-    for timestep in root.findall('timestep'):
+    # Stream timesteps instead of loading the whole trace into memory.
+    context = etree.iterparse(input_path, events=('end',), tag='timestep')
+    for _, timestep in context:
         time = float(timestep.get('time', '0'))
-        for veh in timestep.findall('vehicle'):
+        for veh in timestep.iterfind('vehicle'):
             vid = veh.get('id')
             x = veh.get('x')
             y = veh.get('y')
             if vid is None or x is None or y is None:
                 continue
-            lon = float(x)
-            lat = float(y)
-            entry = {'time': time, 'lat': lat, 'lon': lon}
-            vehicles.setdefault(vid, []).append(entry)
+            buf.add(vid, time, float(y), float(x))
+
+        # Drop the processed timestep (and any earlier siblings) so memory stays flat
+        timestep.clear()
+        while timestep.getprevious() is not None:
+            del timestep.getparent()[0]
+    del context
 
-    out = {'vehicles': vehicles}
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(out, f)
+    buf.write(output_path, npz_path)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert SUMO FCD trace.xml to JSON for Leaflet playback')
     parser.add_argument('--in', dest='infile', default='data/trace.xml', help='input trace.xml')
     parser.add_argument('--out', dest='outfile', default='data/trace.json', help='output trace.json')
+    parser.add_argument('--npz', dest='npzfile', default=None, help='also write columnar samples to this .npz')
+    parser.add_argument('--compress', action='store_true', help='also write .gz (and .zst if available) copies')
     args = parser.parse_args()
-    convert(args.infile, args.outfile)
+    convert(args.infile, args.outfile, args.npzfile)
+    if args.compress:
+        write_compressed(args.outfile)
     print(f'Wrote {args.outfile}')
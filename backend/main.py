@@ -1,5 +1,9 @@
+import os
+import threading
+
 from fastapi import FastAPI
 from celery import Celery
+from psycopg2.pool import ThreadedConnectionPool
 
 app = FastAPI()
 
@@ -9,10 +13,49 @@ celery_app = Celery(
     backend="redis://redis:6379/0"
 )
 
+# Shared Postgres connections; created on first use so the app can start before the db is up
+DB_POOL_MAX = 10
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# getconn() raises PoolError instead of waiting when the pool is exhausted,
+# so callers queue here for a free slot first
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_db_pool():
+    global _db_pool
+    # Only the first callers need the lock; afterwards the pool is read as-is
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ThreadedConnectionPool(
+                    2, DB_POOL_MAX,
+                    dbname=os.environ.get("DB_NAME"),
+                    user=os.environ.get("DB_USER"),
+                    password=os.environ.get("DB_PASSWORD"),
+                    host=os.environ.get("DB_HOST", "db"),
+                    port=os.environ.get("DB_PORT", "5432"),
+                )
+    return _db_pool
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
+@app.get("/db-check")
+def db_check():
+    pool = get_db_pool()
+    with _db_pool_slots:
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        except Exception:
+            # Likely a dead connection (e.g. after a Postgres restart): close it instead of recycling it
+            pool.putconn(conn, close=True)
+            raise
+        pool.putconn(conn)
+    return {"status": "ok"}
+
 @app.get("/trigger-task")
 def trigger_task():
     celery_app.send_task("worker.test_task")
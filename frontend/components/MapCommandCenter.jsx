@@ -19,6 +19,17 @@ L.Marker.prototype.options.icon = DefaultIcon;
 
 const BENGALURU = [12.9716, 77.5946];
 
+// Poll the queued simulation until the worker finishes it
+async function waitForSimulation(taskId, onPending) {
+  while (true) {
+    const res = await fetch(`/api/simulate/status/${taskId}`);
+    const data = await res.json();
+    if (data.status !== 'pending') return data;
+    onPending(data.state);
+    await new Promise(resolve => setTimeout(resolve, 2000));
+  }
+}
+
 // Helper to move map view
 function MapController({ center, zoom }) {
   const map = useMap();
@@ -186,11 +197,17 @@ export default function MapCommandCenter({ onGenerate }) {
           options: optimizeOptions // {widening: bool, signal: bool}
         })
       });
-      const data = await res.json();
+      const queued = await res.json();
+      if (!queued.task_id) { setStatusMsg('Error: ' + queued.message); return; }
+
+      const data = await waitForSimulation(queued.task_id, (state) => setStatusMsg(`Simulating... (${state.toLowerCase()})`));
 
       if (data.status === 'success') {
         setStatusMsg('Simulation Complete detected!');
 
+        // Served pre-compressed (gzip/zstd); the browser decodes it transparently
+        const trace = await (await fetch('/api' + data.trace_url)).json();
+
         // 4. Pass Request to Parent
         onGenerate({
           reportName: `Intervention: ${startLoc.name} - ${endLoc.name}`,
@@ -199,7 +216,8 @@ export default function MapCommandCenter({ onGenerate }) {
           toPlace: endLoc.name,
           totalPeople: Math.floor(Math.random() * 40000),
           selectionGeoJSON: turf.bboxPolygon(bbox),
-          simulationResults: data.data,
+          // trace.vehicles: { vehicleId: [[time, lat, lon], ...] }
+          simulationResults: trace,
           solutions: {
             type: interventionType,
             infraType,
@@ -1,5 +1,17 @@
+import os
+import sys
+import asyncio
 from celery import Celery
 
+# The simulation pipeline lives next to the FastAPI app; mounted at /sumo in docker-compose
+SIMULATION_DIR = os.environ.get(
+    "SIMULATION_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "OSM Rough Backend"),
+)
+sys.path.insert(0, SIMULATION_DIR)
+import common  # noqa: E402
+import pipeline  # noqa: E402
+
 celery_app = Celery(
     "worker",
     broker="redis://redis:6379/0",
@@ -10,3 +22,19 @@ celery_app = Celery(
 def test_task():
     print("Celery task executed successfully!")
     return "done"
+
+# Bounded run time; with send_task's expires= the web app knows when a task must be over
+@celery_app.task(name="worker.run_simulation", bind=True, time_limit=common.SIMULATION_TIMEOUT)
+def run_simulation(self, bbox, new_road=None, infra_type=None):
+    pipeline.evict_task_dirs()
+
+    # Outputs go to DATA_DIR/<task_id>/ so concurrent runs never share files
+    work_dir = os.path.join(pipeline.DATA_DIR, self.request.id)
+    result = None
+    try:
+        result = asyncio.run(pipeline.run_simulation(bbox, new_road, infra_type, work_dir))
+        return result
+    finally:
+        # Keep only the trace the web app serves; runs without one keep nothing
+        keep = pipeline.TRACE_FILES if result and result.get("status") == "success" else ()
+        pipeline.prune_work_dir(work_dir, keep)